@@ -1,10 +1,23 @@
+import asyncio
+import concurrent.futures
 import discord
 from discord.ext import commands
 import datetime
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import os
 import json
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from dataclasses import dataclass
 from typing import Dict, List, Optional, Tuple
 
 # Load configuration
@@ -27,17 +40,75 @@ def load_config() -> dict:
 # Initialize config
 config = load_config()
 
+# Worksheet layouts. Totaux columns D-F hold the live per-day state so
+# each event is an O(1) transition instead of a full-day replay:
+# D = epoch seconds of the current session start, E = seconds worked so
+# far today, F = WORKING / BREAK / empty once checked out.
+# Logs column E is epoch seconds: an integer sort key that is cheaper
+# to order and range-filter on server-side than the HH:MM:SS string.
+LOGS_HEADERS = ["Nom", "Date", "Heure", "Événement", "Epoch"]
+TOTALS_HEADERS = ["Nom", "Date", "Heures Travaillées",
+                  "Début Session", "Secondes Cumulées", "État"]
+
+# Totaux column G holds a sheet-side 'Nom|Date' compound key so the
+# upsert lookup is a single targeted find instead of a full download
+TOTALS_KEY_COL = 7
+TOTALS_KEY_FORMULA = '=ARRAYFORMULA(IF(A2:A="","",A2:A&"|"&B2:B))'
+
+# Event vocabulary. The Logs sheet historically mixed a toggling 'BREAK'
+# marker with 'BREAK START'/'BREAK END'; new rows always use these
+# constants, and the replay loop still understands the legacy marker.
+# Interned so dict dispatch on event types compares by identity first
+CHECK_IN = sys.intern('CHECK IN')
+CHECK_OUT = sys.intern('CHECK OUT')
+BREAK_START = sys.intern('BREAK START')
+BREAK_END = sys.intern('BREAK END')
+LEGACY_BREAK = sys.intern('BREAK')
+
+# On the wire each event is a single character: a Logs row shrinks to
+# roughly half its JSON size, which matters when thousands of rows are
+# fetched. Full labels are decoded on read; the sheet stays readable
+# through a formula column that the API reads never fetch.
+EVENT_CODES = {CHECK_IN: 'I', CHECK_OUT: 'O',
+               BREAK_START: 'B', BREAK_END: 'R'}
+EVENT_LABELS = {code: label for label, code in EVENT_CODES.items()}
+
+def encode_event(event_type: str) -> str:
+    """Label -> single-character wire code (unknown values pass through)"""
+    return EVENT_CODES.get(event_type, event_type)
+
+def decode_event(value: str) -> str:
+    """Wire code -> label; legacy rows already carry full labels"""
+    return EVENT_LABELS.get(value, value)
+
+LOGS_LABEL_FORMULA = ('=ARRAYFORMULA(IF(D2:D="","",SWITCH(D2:D,'
+                      '"I","CHECK IN","O","CHECK OUT",'
+                      '"B","BREAK START","R","BREAK END",D2:D)))')
+
+STATE_WORKING = 'WORKING'
+STATE_BREAK = 'BREAK'
+
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
 # Initialize Google Sheets
 def init_sheets():
     """Initialize Google Sheets client and worksheets"""
     try:
-        scope = [
-            'https://spreadsheets.google.com/feeds',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        creds = ServiceAccountCredentials.from_json_keyfile_name('credentials.json', scope)
-        client = gspread.authorize(creds)
-        
+        creds = Credentials.from_service_account_file('credentials.json', scopes=SCOPES)
+
+        # One authorized session with connection pooling and transport
+        # retries, reused for every call: no TLS handshake per request
+        session = AuthorizedSession(creds)
+        session.mount('https://', HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=0.3)
+        ))
+        client = gspread.Client(auth=creds, session=session)
+
         # Open the spreadsheet by URL
         spreadsheet = client.open_by_url(config['SHEET_URL'])
         
@@ -45,231 +116,893 @@ def init_sheets():
         try:
             time_logs = spreadsheet.worksheet("Logs")
         except gspread.WorksheetNotFound:
-            time_logs = spreadsheet.add_worksheet(title="Logs", rows=1000, cols=4)
-            time_logs.append_row(["Nom", "Date", "Heure", "Événement"])
-            
+            time_logs = spreadsheet.add_worksheet(title="Logs", rows=1000, cols=6)
+            time_logs.append_row(LOGS_HEADERS + ["Libellé"])
+
         try:
             daily_totals = spreadsheet.worksheet("Totaux")
         except gspread.WorksheetNotFound:
-            daily_totals = spreadsheet.add_worksheet(title="Totaux", rows=1000, cols=3)
-            daily_totals.append_row(["Nom", "Date", "Heures Travaillées"])
-        
-        return time_logs, daily_totals
+            daily_totals = spreadsheet.add_worksheet(title="Totaux", rows=1000, cols=7)
+            daily_totals.append_row(TOTALS_HEADERS + ["Clé"])
+
+        # Worksheets created by earlier versions are narrower than the
+        # current layout (Logs=4, Totaux=3 columns); widen them before
+        # touching the added columns, or every read/write outside the
+        # grid fails with a non-retryable 400
+        for worksheet, wanted_cols in ((time_logs, len(LOGS_HEADERS) + 1),
+                                       (daily_totals, TOTALS_KEY_COL)):
+            if worksheet.col_count < wanted_cols:
+                worksheet.add_cols(wanted_cols - worksheet.col_count)
+
+        # Human-readable event labels live in a formula column the API
+        # reads never fetch (init-time only, like the Totaux key below)
+        label_cell = time_logs.acell('F2', value_render_option='FORMULA').value
+        if label_cell != LOGS_LABEL_FORMULA:
+            time_logs.update_acell('F1', "Libellé")
+            time_logs.update_acell('F2', LOGS_LABEL_FORMULA)
+
+        # Make sure the compound-key formula is in place (init-time only)
+        key_cell = daily_totals.acell('G2', value_render_option='FORMULA').value
+        if key_cell != TOTALS_KEY_FORMULA:
+            daily_totals.update_acell('G1', "Clé")
+            daily_totals.update_acell('G2', TOTALS_KEY_FORMULA)
+
+        return client, session, spreadsheet, time_logs, daily_totals
     except Exception as e:
         print(f"Error initializing Google Sheets: {e}")
         raise
 
+# Sheets API statuses worth retrying: quota exhaustion and server errors
+RETRYABLE_STATUSES = (429, 500, 503)
+
+class RateLimiter:
+    """
+    Token bucket sized to the Sheets per-minute request quota. take()
+    blocks (in the worker thread, never on the event loop) until a
+    request slot is available, so bursts queue up instead of tripping
+    429s that would drop events.
+    """
+
+    def __init__(self, capacity: int = 60, refill_per_sec: float = 1.0):
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._refill = refill_per_sec
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity,
+                                   self._tokens + (now - self._updated) * self._refill)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._refill
+            time.sleep(wait)
+
+rate_limiter = RateLimiter()
+
+def with_retry(fn, *args, **kwargs):
+    """
+    Run a Sheets call through the rate limiter, retrying with
+    exponential backoff plus jitter on retryable APIErrors so bursty
+    usage completes instead of silently dropping events.
+    """
+    attempts = 6
+    for attempt in range(attempts):
+        rate_limiter.take()
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = e.response.status_code
+            if status not in RETRYABLE_STATUSES or attempt == attempts - 1:
+                raise
+            time.sleep((2 ** attempt) * 0.25 + random.random() * 0.1)
+
+class LocalLogStore:
+    """
+    SQLite mirror of the Logs sheet. The data is small and append-only,
+    so a local indexed table answers the user/date queries in
+    microseconds instead of a network round-trip. Writes still go
+    through to Sheets; the mirror is updated alongside them.
+    """
+
+    def __init__(self, path: str = 'timelogs.db'):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS logs("
+            "id INTEGER PRIMARY KEY, nom TEXT, date TEXT, "
+            "heure TEXT, evt TEXT, epoch INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_nom_epoch ON logs(nom, epoch)"
+        )
+        self._conn.commit()
+        self._loaded = False
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def load_from(self, records: List[dict]) -> None:
+        """Bulk-load the sheet contents, replacing any previous mirror"""
+        rows = [(r.get('Nom'), r.get('Date'), r.get('Heure'),
+                 encode_event(r.get('Événement')), int(r.get('Epoch') or 0))
+                for r in records]
+        with self._lock:
+            self._conn.execute("DELETE FROM logs")
+            self._conn.executemany(
+                "INSERT INTO logs(nom, date, heure, evt, epoch) "
+                "VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+            self._loaded = True
+
+    def insert(self, row: List) -> None:
+        """Mirror a row that was just appended to the sheet"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO logs(nom, date, heure, evt, epoch) "
+                "VALUES (?, ?, ?, ?, ?)", tuple(row)
+            )
+            self._conn.commit()
+
+    def rows_for(self, username: str, date_str: str) -> List[dict]:
+        """One user's events for one day, in chronological order"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT nom, date, heure, evt, epoch FROM logs "
+                "WHERE nom = ? AND date = ? ORDER BY epoch, id",
+                (username, date_str)
+            )
+            records = [dict(zip(LOGS_HEADERS, row)) for row in cursor.fetchall()]
+        for record in records:
+            record['Événement'] = decode_event(record['Événement'])
+        return records
+
+class CachedWorksheet:
+    """
+    Wrap a gspread worksheet with a short-TTL record cache so commands
+    issued close together (e.g. !break then !status) share one fetch
+    instead of each doing a full round-trip to the Sheets API.
+
+    The cache is columnar: one numpy object array per header (structure
+    of arrays), which costs far less memory than a list of per-row dicts
+    and lets user/date filters run as vectorized equality masks. Row
+    dicts are materialized only for the rows a caller actually asks for.
+
+    Appended rows go into an in-memory tail so reads stay fresh without
+    refetching; updates patch the cached cell in place. A lock guards
+    the cache because gspread calls are sync while discord.py callbacks
+    run on the event loop.
+    """
+
+    TTL = 30  # seconds
+
+    # Positional writes never grow the grid the way append_row did, so
+    # reserve_row adds capacity before the counter reaches the edge
+    GROW_MARGIN = 10
+    GROW_CHUNK = 1000
+
+    def __init__(self, worksheet, headers: List[str]):
+        self._ws = worksheet
+        self._headers = headers
+        self._decode_events = 'Événement' in headers
+        self._lock = threading.Lock()
+        self._columns: Optional[Dict[str, np.ndarray]] = None
+        # Rows reserved but possibly not flushed yet, keyed by their
+        # 1-based sheet row number
+        self._tail: Dict[int, List] = {}
+        self._base_size = 0  # server-side row count at the last refresh
+        self._fetched_at = 0.0
+        self._next_row: Optional[int] = None
+
+    def _refresh_if_stale(self) -> None:
+        with self._lock:
+            if self._columns is not None and time.time() - self._fetched_at < self.TTL:
+                return
+
+        ncols = len(self._headers)
+        rows = [row[:ncols] + [''] * (ncols - len(row))
+                for row in with_retry(self._ws.get_all_values)[1:]]
+        # Formula columns can yield trailing all-empty rows; drop them
+        rows = [row for row in rows if any(cell != '' for cell in row)]
+        with self._lock:
+            self._columns = {
+                header: np.array([row[i] for row in rows], dtype=object)
+                for i, header in enumerate(self._headers)
+            }
+            # Tail rows still queued for the write flusher are absent
+            # from the fetch; drop the ones whose row numbers the fetch
+            # now covers and keep the still-pending remainder visible
+            self._tail = {row: values for row, values in self._tail.items()
+                          if row > len(rows) + 1}
+            self._base_size = len(rows)
+            self._fetched_at = time.time()
+
+    def _materialize(self, values) -> dict:
+        """Build a row dict, translating event wire codes back to labels"""
+        record = dict(zip(self._headers, values))
+        if self._decode_events:
+            record['Événement'] = decode_event(record['Événement'])
+        return record
+
+    def _record_at(self, index: int) -> dict:
+        """Materialize one row dict from the columns. Caller holds the lock."""
+        return self._materialize([self._columns[h][index] for h in self._headers])
+
+    def get_all_records(self) -> List[dict]:
+        self._refresh_if_stale()
+        with self._lock:
+            records = [self._materialize(row)
+                       for row in zip(*(self._columns[h] for h in self._headers))]
+            records.extend(self._materialize(self._tail[row])
+                           for row in sorted(self._tail))
+            return records
+
+    def rows_for(self, user: str, date: Optional[str] = None) -> List[dict]:
+        """
+        Return the cached rows for a user, optionally restricted to one
+        date, selected with vectorized equality masks on the columns.
+        """
+        self._refresh_if_stale()
+        with self._lock:
+            mask = self._columns['Nom'] == user
+            if date is not None:
+                mask &= self._columns['Date'] == date
+            selected = [self._record_at(int(i)) for i in np.nonzero(mask)[0]]
+            for row in sorted(self._tail):
+                record = self._materialize(self._tail[row])
+                if record.get('Nom') == user and (date is None or record.get('Date') == date):
+                    selected.append(record)
+            return selected
+
+    def find_row(self, user: str, date: str) -> Optional[int]:
+        """
+        1-based row number of the cached (Nom, Date) row, or None. Sees
+        rows still queued for the write flusher, unlike a server find.
+        """
+        self._refresh_if_stale()
+        with self._lock:
+            mask = (self._columns['Nom'] == user) & (self._columns['Date'] == date)
+            indexes = np.nonzero(mask)[0]
+            if len(indexes):
+                return int(indexes[0]) + 2
+            for row in sorted(self._tail):
+                values = self._tail[row]
+                if values[0] == user and values[1] == date:
+                    return row
+            return None
+
+    def last_event_for(self, user: str) -> Optional[dict]:
+        """The user's most recent cached row"""
+        self._refresh_if_stale()
+        with self._lock:
+            for row in sorted(self._tail, reverse=True):
+                values = self._tail[row]
+                if values and values[0] == user:
+                    return self._materialize(values)
+            indexes = np.nonzero(self._columns['Nom'] == user)[0]
+            if len(indexes) == 0:
+                return None
+            return self._record_at(int(indexes[-1]))
+
+    def record_for_row(self, row: int) -> Optional[dict]:
+        """The materialized record at a 1-based sheet row, or None when
+        the cache does not hold that row."""
+        self._refresh_if_stale()
+        with self._lock:
+            index = row - 2
+            if 0 <= index < len(self._columns[self._headers[0]]):
+                return self._record_at(index)
+            values = self._tail.get(row)
+            return self._materialize(values) if values is not None else None
+
+    def reserve_row(self, values: Optional[List] = None) -> int:
+        """
+        Atomically claim the next free 1-based row for a positional
+        write. The counter is seeded from the sheet size and only moves
+        forward, so concurrent commands never contend on a shared
+        'append to the last row' and each gets a distinct target — the
+        bot is the sheet's only writer, which keeps the counter honest
+        across cache refreshes. When `values` are given they are stored
+        in the tail under the claimed row number in the same lock hold,
+        so the cache's row mapping cannot invert when worker threads
+        run out of reservation order.
+        """
+        self._refresh_if_stale()
+        with self._lock:
+            derived = self._base_size + 2
+            if self._tail:
+                derived = max(derived, max(self._tail) + 1)
+            if self._next_row is None or self._next_row < derived:
+                self._next_row = derived
+            row = self._next_row
+            self._next_row += 1
+            if values is not None:
+                self._tail[row] = list(values)
+
+        # Writing past the grid is a non-retryable 400, so grow it ahead
+        # of need (outside the lock: this is a network call). A spurious
+        # extra grow from a racing thread only costs unused blank rows.
+        if row + self.GROW_MARGIN >= self._ws.row_count:
+            with_retry(self._ws.add_rows, self.GROW_CHUNK)
+        return row
+
+    def update_cell(self, row: int, col: int, value) -> None:
+        with_retry(self._ws.update_cell, row, col, value)
+        self.note_update(row, col, value)
+
+    def note_update(self, row: int, col: int, value) -> None:
+        """Patch a cell in the cache without issuing a write."""
+        with self._lock:
+            if self._columns is None:
+                return
+            # Row 1 is the header row, so cached index is row - 2
+            index = row - 2
+            size = len(self._columns[self._headers[0]])
+            if 0 <= index < size:
+                self._columns[self._headers[col - 1]][index] = value
+            elif row in self._tail:
+                tail_row = self._tail[row]
+                while len(tail_row) < col:
+                    tail_row.append('')
+                tail_row[col - 1] = value
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._columns = None
+            self._tail = {}
+            self._base_size = 0
+
+    def __getattr__(self, name):
+        # Delegate everything else (find, acell, ...) to gspread
+        return getattr(self._ws, name)
+
 # Bot setup
 intents = discord.Intents.default()
 intents.message_content = True
 bot = commands.Bot(command_prefix='!', intents=intents)
 
 # Global variables
+sheets_client = None
+auth_session = None
+spreadsheet = None
 time_logs = None
 daily_totals = None
+local_logs = LocalLogStore()
+
+# Memoized day totals: (user, date) -> (event_seq, formatted_time).
+# log_event bumps the sequence for a day whenever it records an event
+# there, so a cached total is valid exactly while no newer event exists.
+_totals_cache: Dict[Tuple[str, str], Tuple[int, str]] = {}
+_event_seq: Dict[Tuple[str, str], int] = {}
+_totals_cache_lock = threading.Lock()
+
+# Set once the Sheets connection is up; commands wait on it briefly
+# instead of poking at globals that may still be None
+sheets_ready = asyncio.Event()
+_bootstrap_task = None
+
+# Value ranges waiting for the background flusher. log_event runs in
+# worker threads, so a lock-guarded list stands in for an asyncio queue;
+# the flusher swaps it out and sends one batched write per interval.
+_pending_writes: List[dict] = []
+_pending_writes_lock = threading.Lock()
+
+FLUSH_INTERVAL = 1.0  # seconds: the latency ceiling traded for batching
+FLUSH_MAX_RANGES = 50
+FLUSH_MAX_FAILURES = 5  # consecutive failures before a chunk is dropped
+DEAD_LETTER_FILE = 'failed_writes.jsonl'
+
+def enqueue_writes(entries: List[dict]) -> None:
+    """Queue value ranges for the next coalesced batch write"""
+    with _pending_writes_lock:
+        _pending_writes.extend(entries)
+
+def _dead_letter(chunk: List[dict], error: Exception) -> None:
+    """
+    Record value ranges the flusher gave up on, so they can be replayed
+    by hand, and invalidate the caches that claim they exist.
+    """
+    try:
+        with open(DEAD_LETTER_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'error': str(error), 'data': chunk},
+                               ensure_ascii=False) + '\n')
+    except OSError as e:
+        print(f"Error writing dead-letter file: {e}")
+    for cache in (time_logs, daily_totals):
+        if cache is not None:
+            cache.invalidate()
+
+async def write_flusher():
+    """
+    Flush queued value ranges with one values_batch_update per interval.
+    Many concurrent commands then cost one HTTPS request instead of one
+    each, at a ~1 s latency ceiling on sheet visibility.
+    """
+    await sheets_ready.wait()
+    failures = 0
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        with _pending_writes_lock:
+            data = _pending_writes[:]
+            _pending_writes.clear()
+        while data:
+            chunk, data = data[:FLUSH_MAX_RANGES], data[FLUSH_MAX_RANGES:]
+            try:
+                await asyncio.to_thread(
+                    with_retry, spreadsheet.values_batch_update,
+                    {'valueInputOption': 'RAW', 'data': chunk}
+                )
+                failures = 0
+            except Exception as e:
+                failures += 1
+                if failures >= FLUSH_MAX_FAILURES:
+                    # A poisoned head chunk (e.g. a non-retryable 400)
+                    # would otherwise block everything queued behind it
+                    # forever: drop it to the dead-letter file and move
+                    # on with the rest of the queue
+                    print(f"Dropping {len(chunk)} value ranges after "
+                          f"{failures} failed flushes: {e}")
+                    _dead_letter(chunk, e)
+                    failures = 0
+                    continue
+                print(f"Error flushing queued writes, requeueing: {e}")
+                # The caches (and the users' ✅) already claim these
+                # writes exist; put them back in order and retry next
+                # interval rather than dropping them
+                with _pending_writes_lock:
+                    _pending_writes[0:0] = chunk + data
+                break
+
+def fetch_user_day(username: str, date_str: str) -> List[dict]:
+    """
+    Fetch only the given user's rows for one day.
+    The local SQLite mirror answers this without touching the network;
+    if it has not been loaded yet, fall back to a Google Visualization
+    query so only matching rows cross the wire, then to the record cache.
+    """
+    if local_logs.loaded:
+        return local_logs.rows_for(username, date_str)
+
+    try:
+        # Range-filter and sort on the integer Epoch column server-side;
+        # it is cheaper than string comparisons on Date/Heure
+        day_start = int(datetime.datetime.strptime(date_str, "%Y-%m-%d").timestamp())
+        day_end = day_start + 86400
+
+        # Backslash-escape the string-literal delimiters so names with
+        # quotes don't break the query (and fall back on every call)
+        safe_user = username.replace('\\', '\\\\').replace("'", "\\'")
+
+        response = auth_session.get(
+            f"https://docs.google.com/spreadsheets/d/{spreadsheet.id}/gviz/tq",
+            params={
+                'tq': (f"select A,B,C,D,E where A='{safe_user}' "
+                       f"and E >= {day_start} and E < {day_end} order by E"),
+                'sheet': "Logs",
+                'headers': 1
+            },
+            timeout=10
+        )
+        response.raise_for_status()
+
+        # The response is JSONP: strip the wrapper to get the JSON payload
+        body = response.text
+        payload = json.loads(body[body.index('{'):body.rindex('}') + 1])
+
+        records = []
+        for row in payload['table']['rows']:
+            cells = [c['v'] if c else None for c in row['c']]
+            record = dict(zip(LOGS_HEADERS, cells))
+            record['Événement'] = decode_event(record['Événement'])
+            records.append(record)
+        return records
+    except Exception as e:
+        print(f"gviz query failed, falling back to full scan: {e}")
+        return time_logs.rows_for(username, date_str)
+
+def find_total_row(username: str, date_str: str) -> Optional[int]:
+    """
+    Locate the "Totaux" row for (username, date) with one server-side
+    find against the compound key column instead of downloading the
+    whole sheet.
+    Returns the 1-based row number, or None if no entry exists yet.
+    """
+    # The cache sees rows still queued for the flusher, so consult it
+    # before the server
+    cached_row = daily_totals.find_row(username, date_str)
+    if cached_row is not None:
+        return cached_row
+
+    cell = with_retry(daily_totals.find, f"{username}|{date_str}",
+                      in_column=TOTALS_KEY_COL)
+    return cell.row if cell else None
+
+# The Heure column always has the fixed 'HH:MM:SS' shape, so a
+# precompiled pattern beats walking strptime's format-string DSL
+_HMS = re.compile(r'^(\d{2}):(\d{2}):(\d{2})$')
+
+def hms_to_sec(hms: str) -> int:
+    """Parse an 'HH:MM:SS' string into an integer second-of-day"""
+    m = _HMS.match(hms)
+    return int(m[1]) * 3600 + int(m[2]) * 60 + int(m[3])
+
+def format_duration(total_seconds: float) -> str:
+    """Format a duration in seconds as 9h55m00s"""
+    hours = int(total_seconds // 3600)
+    minutes = int((total_seconds % 3600) // 60)
+    seconds = int(total_seconds % 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s"
 
-def log_event(username: str, event_type: str) -> bool:
+def log_event(username: str, event_type: str,
+              now: Optional[datetime.datetime] = None) -> bool:
     """
-    Log an event to Google Sheets
+    Log an event to Google Sheets and apply an O(1) state transition on
+    the user's Totaux row, so totals never require replaying the day.
+    Callers that show the user a timestamp pass their own `now` so the
+    logged time and the displayed time cannot drift apart.
     Returns True if successful, False otherwise
     """
     try:
-        now = datetime.datetime.now()
+        if now is None:
+            now = datetime.datetime.now()
         date_str = now.strftime("%Y-%m-%d")
         time_str = now.strftime("%H:%M:%S")
-        
-        # Log to Time Logs
-        time_logs.append_row([username, date_str, time_str, event_type])
-        
-        # If checking out, calculate total hours
-        if event_type == "CHECK OUT":
-            calculate_daily_hours(username, date_str)
-        
+        now_epoch = int(now.timestamp())
+        row = [username, date_str, time_str, encode_event(event_type), now_epoch]
+
+        logs_row = time_logs.reserve_row(row)
+        data = [{'range': f"Logs!A{logs_row}:E{logs_row}", 'values': [row]}]
+
+        # Read the current state from the cached Totaux row
+        totals_row = find_total_row(username, date_str)
+        total_display = ''
+        start_epoch, accumulated, state = 0, 0, ''
+        if totals_row is not None:
+            record = daily_totals.record_for_row(totals_row)
+            if record is None:
+                # Row located by server-side find but not in the cache:
+                # read it from the sheet instead
+                values = with_retry(daily_totals.row_values, totals_row)
+                values = values + [''] * (len(TOTALS_HEADERS) - len(values))
+                record = dict(zip(TOTALS_HEADERS, values))
+            total_display = record.get('Heures Travaillées') or ''
+            start_epoch = int(record.get('Début Session') or 0)
+            accumulated = int(record.get('Secondes Cumulées') or 0)
+            state = record.get('État') or ''
+
+        # Apply the transition for this event
+        if event_type == CHECK_IN:
+            start_epoch, state = now_epoch, STATE_WORKING
+        elif event_type == BREAK_START:
+            if state == STATE_WORKING and start_epoch:
+                accumulated += now_epoch - start_epoch
+            start_epoch, state = 0, STATE_BREAK
+        elif event_type == BREAK_END:
+            start_epoch, state = now_epoch, STATE_WORKING
+        elif event_type == CHECK_OUT:
+            if state == STATE_WORKING and start_epoch:
+                accumulated += now_epoch - start_epoch
+                total_display = format_duration(accumulated)
+            else:
+                # No live state (rows predating the state columns, or a
+                # checkout without check-in): replay the day's events
+                total_display = calculate_daily_hours(username, date_str,
+                                                      pending_row=row) or total_display
+            start_epoch, state = 0, ''
+
+        totals_values = [username, date_str, total_display,
+                         start_epoch or '', accumulated, state]
+
+        new_entry = totals_row is None
+        if new_entry:
+            totals_row = daily_totals.reserve_row(totals_values)
+        data.append({'range': f"Totaux!A{totals_row}:F{totals_row}",
+                     'values': [totals_values]})
+
+        # Queue both ranges for the coalescing flusher; the caches were
+        # already updated when the rows were reserved, so reads never
+        # wait on the flush
+        enqueue_writes(data)
+
+        # Keep the local mirror and the memo generation in sync
+        local_logs.insert(row)
+        with _totals_cache_lock:
+            _event_seq[(username, date_str)] = _event_seq.get((username, date_str), 0) + 1
+            if event_type == CHECK_OUT and total_display:
+                # The O(1) transition path never goes through
+                # calculate_daily_hours, so seed the memo here; !status
+                # reads it until the next event invalidates it
+                _totals_cache[(username, date_str)] = (
+                    _event_seq[(username, date_str)], total_display)
+        if not new_entry:
+            for col, value in enumerate(totals_values, start=1):
+                daily_totals.note_update(totals_row, col, value)
+
         return True
     except Exception as e:
         print(f"Error logging event: {e}")
         return False
 
-def calculate_daily_hours(username: str, date_str: str) -> Optional[str]:
-    """Calculate daily working hours and return formatted as 9h55m00s"""
+@dataclass
+class DayState:
+    """Mutable replay state for one user's day, in integer seconds"""
+    total_seconds: int = 0
+    session_start: Optional[int] = None
+    in_break: bool = False
+    break_start: Optional[int] = None
+
+def _on_check_in(state: DayState, event_sec: int) -> None:
+    if state.session_start is None:  # New session starts
+        state.session_start = event_sec
+
+def _on_break_start(state: DayState, event_sec: int) -> None:
+    if not state.in_break and state.session_start is not None:
+        # Add time from session start to break start
+        state.total_seconds += event_sec - state.session_start
+        state.in_break = True
+        state.break_start = event_sec
+
+def _on_break_end(state: DayState, event_sec: int) -> None:
+    if state.in_break:
+        state.in_break = False
+        state.session_start = event_sec  # New session starts after break
+
+def _on_legacy_break(state: DayState, event_sec: int) -> None:
+    # The old 'BREAK' marker toggled: it starts a break while working
+    # and ends one otherwise
+    if state.in_break:
+        _on_break_end(state, event_sec)
+    else:
+        _on_break_start(state, event_sec)
+
+def _on_check_out(state: DayState, event_sec: int) -> None:
+    if state.session_start is not None and not state.in_break:
+        # Add time from session start to check out
+        state.total_seconds += event_sec - state.session_start
+    state.session_start = None  # Reset for possible new session
+
+# One dict lookup per record instead of walking an if/elif chain
+REPLAY_HANDLERS = {
+    CHECK_IN: _on_check_in,
+    BREAK_START: _on_break_start,
+    BREAK_END: _on_break_end,
+    LEGACY_BREAK: _on_legacy_break,
+    CHECK_OUT: _on_check_out,
+}
+
+def memoized_daily_total(username: str, date_str: str) -> Optional[str]:
+    """
+    The memoized total for a (user, day), or None when an event has
+    been logged since it was computed and it can no longer be trusted.
+    """
+    key = (username, date_str)
+    with _totals_cache_lock:
+        cached = _totals_cache.get(key)
+        if cached is not None and cached[0] == _event_seq.get(key, 0):
+            return cached[1]
+    return None
+
+def calculate_daily_hours(username: str, date_str: str,
+                          pending_row: Optional[List] = None) -> Optional[str]:
+    """
+    Calculate daily working hours and return them formatted as 9h55m00s.
+    pending_row is an event that has not been written to the sheet yet
+    (the caller batches it together with the Totaux write).
+    """
     if time_logs is None or daily_totals is None:
         return None
-        
+
+    # Serve the memoized total if no event has been logged since it
+    # was computed (a pending row is such an event by definition)
+    key = (username, date_str)
+    if pending_row is None:
+        memoized = memoized_daily_total(username, date_str)
+        if memoized is not None:
+            return memoized
+
     try:
-        # Get all records for the user on the given date
-        records = time_logs.get_all_records()
-        user_records = [r for r in records if r['Nom'] == username and r['Date'] == date_str]
-        
+        # Get only this user's records for the given date
+        user_records = fetch_user_day(username, date_str)
+        if pending_row is not None:
+            pending = dict(zip(LOGS_HEADERS, pending_row))
+            pending['Événement'] = decode_event(pending['Événement'])
+            user_records.append(pending)
+
         if not user_records:
             return None
-            
-        # Sort records by time
-        user_records.sort(key=lambda x: x['Heure'])
-        
-        total_seconds = 0
-        current_session_start = None
-        in_break = False
-        break_start = None
-        
+
+        # Records arrive ordered: the gviz query sorts by Epoch, and the
+        # cache fallback preserves append (i.e. chronological) order.
+        # All events are same-day, so plain integer seconds-of-day
+        # replace datetime.combine() arithmetic on the hot loop.
+        state = DayState()
+        handlers = REPLAY_HANDLERS
         for record in user_records:
-            event_time = datetime.datetime.strptime(record['Heure'], '%H:%M:%S').time()
-            
-            if record['Événement'] == 'CHECK IN':
-                if current_session_start is None:  # New session starts
-                    current_session_start = event_time
-                    
-            elif record['Événement'] == 'BREAK':
-                if not in_break and current_session_start:  # Start break
-                    # Add time from session start to break start
-                    session_seconds = (datetime.datetime.combine(datetime.date.today(), event_time) - 
-                                     datetime.datetime.combine(datetime.date.today(), current_session_start)).total_seconds()
-                    total_seconds += session_seconds
-                    in_break = True
-                    break_start = event_time
-                elif in_break:  # End break
-                    in_break = False
-                    current_session_start = event_time  # New session starts after break
-                    
-            elif record['Événement'] == 'CHECK OUT':
-                if current_session_start and not in_break:
-                    # Add time from session start to check out
-                    session_seconds = (datetime.datetime.combine(datetime.date.today(), event_time) - 
-                                     datetime.datetime.combine(datetime.date.today(), current_session_start)).total_seconds()
-                    total_seconds += session_seconds
-                current_session_start = None  # Reset for possible new session
-        
+            handler = handlers.get(record['Événement'])
+            if handler is not None:
+                handler(state, hms_to_sec(record['Heure']))
+
         # Handle case where user is still in a break at the end of records
-        if in_break and break_start and current_session_start:
-            # Add time from session start to break start
-            session_seconds = (datetime.datetime.combine(datetime.date.today(), break_start) - 
-                             datetime.datetime.combine(datetime.date.today(), current_session_start)).total_seconds()
-            total_seconds += session_seconds
-        
-        # Convert total seconds to hours, minutes, seconds
-        hours = int(total_seconds // 3600)
-        minutes = int((total_seconds % 3600) // 60)
-        seconds = int(total_seconds % 60)
-        
+        if (state.in_break and state.break_start is not None
+                and state.session_start is not None):
+            state.total_seconds += state.break_start - state.session_start
+
         # Format as 9h55m00s
-        formatted_time = f"{hours}h{minutes:02d}m{seconds:02d}s"
-        
-        # Check if entry for this user and date already exists
-        existing_entries = daily_totals.get_all_records()
-        entry_updated = False
-        
-        for i, entry in enumerate(existing_entries, start=2):  # Start from row 2 (1-based)
-            if entry['Nom'] == username and entry['Date'] == date_str:
-                daily_totals.update_cell(i, 3, formatted_time)  # Update existing entry
-                entry_updated = True
-                break
-        
-        if not entry_updated:
-            daily_totals.append_row([username, date_str, formatted_time])  # Add new entry
-        
-        return formatted_time
-        
+        formatted = format_duration(state.total_seconds)
+        with _totals_cache_lock:
+            # A pending row is recorded (and the sequence bumped) right
+            # after this call, so cache against the post-write sequence
+            seq = _event_seq.get(key, 0)
+            _totals_cache[key] = (seq + 1 if pending_row is not None else seq,
+                                  formatted)
+        return formatted
+
     except Exception as e:
         print(f"Error calculating daily hours: {str(e)}")
         return None
 
-@bot.event
-async def on_ready():
-    """Called when the bot is ready"""
-    global time_logs, daily_totals
-    print(f'Logged in as {bot.user.name} (ID: {bot.user.id})')
-    print('------')
-    
+async def _bootstrap():
+    """Connect to Google Sheets off the event loop, then open the gate"""
+    global sheets_client, auth_session, spreadsheet, time_logs, daily_totals
     try:
-        time_logs, daily_totals = init_sheets()
+        (sheets_client, auth_session, spreadsheet,
+         logs_ws, totals_ws) = await asyncio.to_thread(init_sheets)
+        time_logs = CachedWorksheet(logs_ws, LOGS_HEADERS)
+        daily_totals = CachedWorksheet(totals_ws, TOTALS_HEADERS)
+        # Seed the local SQLite mirror with one bulk fetch
+        await asyncio.to_thread(
+            lambda: local_logs.load_from(time_logs.get_all_records())
+        )
+        sheets_ready.set()
         print("Successfully connected to Google Sheets")
     except Exception as e:
         print(f"Failed to initialize Google Sheets: {e}")
         print("Bot will continue with limited functionality")
 
+async def ensure_sheets_ready(ctx) -> bool:
+    """Wait briefly for the Sheets connection, telling the user if it
+    is not up yet. Returns True when commands may proceed."""
+    try:
+        await asyncio.wait_for(sheets_ready.wait(), timeout=5)
+        return True
+    except asyncio.TimeoutError:
+        await ctx.send("⏳ Connexion à Google Sheets en cours. Veuillez réessayer dans un instant.")
+        return False
+
+@bot.event
+async def on_ready():
+    """Called when the bot is ready"""
+    global _bootstrap_task
+    print(f'Logged in as {bot.user.name} (ID: {bot.user.id})')
+    print('------')
+
+    # on_ready can fire again on reconnects; only bootstrap once
+    if _bootstrap_task is None:
+        # Bounded pool for the sync gspread calls commands push off the loop
+        asyncio.get_running_loop().set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        )
+        _bootstrap_task = asyncio.create_task(_bootstrap())
+        asyncio.create_task(write_flusher())
+
 @bot.command(name='checkin')
 async def check_in(ctx):
     """Check in to start tracking work time"""
-    if log_event(ctx.author.name, "CHECK IN"):
-        await ctx.send(f"✅ {ctx.author.name} a commencé à travailler à {datetime.datetime.now().strftime('%H:%M:%S')}")
+    if not await ensure_sheets_ready(ctx):
+        return
+    now = datetime.datetime.now()
+    if await asyncio.to_thread(log_event, ctx.author.name, CHECK_IN, now):
+        await ctx.send(f"✅ {ctx.author.name} a commencé à travailler à {now.strftime('%H:%M:%S')}")
     else:
         await ctx.send("❌ Échec de l'enregistrement. Veuillez réessayer.")
 
 @bot.command(name='checkout')
 async def check_out(ctx):
     """Check out to stop tracking work time"""
-    if log_event(ctx.author.name, "CHECK OUT"):
-        await ctx.send(f"✅ {ctx.author.name} a terminé à {datetime.datetime.now().strftime('%H:%M:%S')}")
+    if not await ensure_sheets_ready(ctx):
+        return
+    now = datetime.datetime.now()
+    if await asyncio.to_thread(log_event, ctx.author.name, CHECK_OUT, now):
+        await ctx.send(f"✅ {ctx.author.name} a terminé à {now.strftime('%H:%M:%S')}")
     else:
         await ctx.send("❌ Échec de l'enregistrement. Veuillez réessayer.")
 
 @bot.command(name='break')
 async def take_break(ctx):
     """Start or end a break"""
-    user_logs = time_logs.get_all_records()
-    user_logs = [log for log in user_logs if log['Nom'] == ctx.author.name]
-    
-    # Check if user is currently on a break
-    last_break = next(
-        (log for log in reversed(user_logs) if log['Événement'] in ['BREAK START', 'BREAK END']),
-        None
-    )
-    
-    if last_break is None or last_break['Événement'] == 'BREAK END':
+    if not await ensure_sheets_ready(ctx):
+        return
+    now = datetime.datetime.now()
+    # The user is on a break iff their most recent event started one
+    last_event = await asyncio.to_thread(time_logs.last_event_for, ctx.author.name)
+
+    if last_event is None or last_event['Événement'] != BREAK_START:
         # Start a new break
-        if log_event(ctx.author.name, "BREAK START"):
-            await ctx.send(f"⏸️ {ctx.author.name} a commencé une pause à {datetime.datetime.now().strftime('%H:%M:%S')}")
+        if await asyncio.to_thread(log_event, ctx.author.name, BREAK_START, now):
+            await ctx.send(f"⏸️ {ctx.author.name} a commencé une pause à {now.strftime('%H:%M:%S')}")
         else:
             await ctx.send("❌ Échec de l'enregistrement de la pause. Veuillez réessayer.")
     else:
         # End the current break
-        if log_event(ctx.author.name, "BREAK END"):
-            await ctx.send(f"▶️ {ctx.author.name} a repris le travail à {datetime.datetime.now().strftime('%H:%M:%S')}")
+        if await asyncio.to_thread(log_event, ctx.author.name, BREAK_END, now):
+            await ctx.send(f"▶️ {ctx.author.name} a repris le travail à {now.strftime('%H:%M:%S')}")
         else:
             await ctx.send("❌ Échec de l'enregistrement de la fin de pause. Veuillez réessayer.")
 
+def build_status_message(username: str) -> Optional[str]:
+    """
+    Build the !status reply for a user. Sync helper: it touches the
+    worksheet caches, so commands run it in a thread off the event loop.
+    """
+    user_logs = time_logs.rows_for(username)
+
+    if not user_logs:
+        return None
+
+    last_event = user_logs[-1]
+    status_msg = f"👤 **Statut de {username}**\n"
+    status_msg += f"📅 Dernier événement: {last_event['Événement']} à {last_event['Heure']} le {last_event['Date']}\n"
+
+    # Calculate today's total hours
+    today = datetime.datetime.now().strftime("%Y-%m-%d")
+    today_logs = time_logs.rows_for(username, today)
+
+    if today_logs:
+        # Find the most recent check-in
+        check_ins = [log for log in today_logs if log['Événement'] == CHECK_IN]
+        if check_ins:
+            last_check_in = check_ins[-1]
+            # The Epoch column spares a strptime; rows predating it fall
+            # back to the fixed-shape Heure parse (the date is today's)
+            check_in_epoch = int(last_check_in.get('Epoch') or 0)
+            if check_in_epoch:
+                elapsed = time.time() - check_in_epoch
+            else:
+                now = datetime.datetime.now()
+                now_sec = now.hour * 3600 + now.minute * 60 + now.second
+                elapsed = now_sec - hms_to_sec(last_check_in['Heure'])
+            status_msg += f"⏱️ En train de travailler depuis: {elapsed / 3600:.1f} heures\n"
+
+    # Get today's total: the memoized figure from the last checkout is
+    # current as long as no event was logged since, and spares the
+    # Totaux sweep
+    today_total_time = memoized_daily_total(username, today)
+    if today_total_time is None:
+        daily_records = daily_totals.get_all_records()
+        today_total = next(
+            (entry for entry in daily_records
+             if entry['Nom'] == username and entry['Date'] == today),
+            None
+        )
+        # The state row exists from the first check-in with an empty
+        # total, so guard on the value rather than the row
+        if today_total and today_total['Heures Travaillées']:
+            today_total_time = today_total['Heures Travaillées']
+
+    if today_total_time:
+        status_msg += f"📊 Total des heures aujourd'hui: {today_total_time}h"
+
+    return status_msg
+
 @bot.command(name='status')
 async def status(ctx):
     """Show your current status"""
+    if not await ensure_sheets_ready(ctx):
+        return
     try:
-        logs = time_logs.get_all_records()
-        user_logs = [log for log in logs if log['Nom'] == ctx.author.name]
-        
-        if not user_logs:
+        status_msg = await asyncio.to_thread(build_status_message, ctx.author.name)
+
+        if status_msg is None:
             await ctx.send("Aucun temps enregistré pour le moment.")
             return
-        
-        last_event = user_logs[-1]
-        status_msg = f"👤 **Statut de {ctx.author.name}**\n"
-        status_msg += f"📅 Dernier événement: {last_event['Événement']} à {last_event['Heure']} le {last_event['Date']}\n"
-        
-        # Calculate today's total hours
-        today = datetime.datetime.now().strftime("%Y-%m-%d")
-        today_logs = [log for log in user_logs if log['Date'] == today]
-        
-        if today_logs:
-            # Find the most recent check-in
-            check_ins = [log for log in today_logs if log['Événement'] == 'CHECK IN']
-            if check_ins:
-                last_check_in = check_ins[-1]
-                check_in_time = datetime.datetime.strptime(
-                    f"{last_check_in['Date']} {last_check_in['Heure']}", 
-                    "%Y-%m-%d %H:%M:%S"
-                )
-                current_time = datetime.datetime.now()
-                hours_worked = (current_time - check_in_time).total_seconds() / 3600
-                status_msg += f"⏱️ En train de travailler depuis: {hours_worked:.1f} heures\n"
-        
-        # Get today's total from daily totals
-        daily_records = daily_totals.get_all_records()
-        today_total = next(
-            (entry for entry in daily_records 
-             if entry['Nom'] == ctx.author.name and entry['Date'] == today),
-            None
-        )
-        
-        if today_total:
-            status_msg += f"📊 Total des heures aujourd'hui: {today_total['Heures Travaillées']}h"
-        
+
         await ctx.send(status_msg)
     except Exception as e:
         print(f"Error getting status: {e}")